@@ -1,13 +1,17 @@
 # app.py
 import streamlit as st
-import os
-from langchain_core.tools import StructuredTool # For dynamic tool creation
-from langchain_core.utils.function_calling import convert_to_openai_function
+import atexit
+import asyncio
+import hashlib
+import threading
+from contextlib import aclosing
+from functools import partial
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from src.agent.state import AgentState
-# Import the Pydantic schema and the raw sending function
-from src.agent.tools import SendEmailArgsSchema, send_email_func 
-from src.core.llm import create_llm # Import the LLM factory function
-from src.agent.graph import build_email_agent, AGENT_CONFIG # Import the graph constructor and the config bridge
+# Import the SMTP connection pool, the raw sending function and the recipient check
+from src.agent.tools import SMTPConnectionPool, send_email_func, parse_recipient 
+from src.core.llm import create_llm, MODEL_ID # Import the LLM factory function and model id
+from src.agent.graph import build_email_agent, compose_email, resume_from_send, CheckpointThreads, EmailDecisionSchema # Import the graph constructor, drafting call, resume helpers and output schema
 
 # --- Configuration & Setup ---
 
@@ -18,6 +22,11 @@ st.markdown("---")
 # Use constants for host/port
 EMAIL_HOST = "smtp.gmail.com"
 EMAIL_PORT = 587
+# Upper bound on open SMTP sessions, and how long an unused one is kept (seconds)
+SMTP_POOL_SIZE = 16
+SMTP_IDLE_TTL = 600
+# Upper bound on runs kept in the shared checkpointer (only needed for Retry Sending)
+CHECKPOINT_THREADS = 64
 
 # --- Collect Credentials in Streamlit UI ---
 st.sidebar.header("🔑 User Credentials")
@@ -26,20 +35,138 @@ smtp_username = st.sidebar.text_input("SMTP Username (Sender Email):", type="pas
 smtp_password = st.sidebar.text_input("SMTP App Password:", type="password", help="Your 16-character Google App Password (required if 2FA is on).")
 st.sidebar.caption("All credentials are used only for this session.")
 
+# --- Cached Resources ---
+
+@st.cache_resource
+def get_compiled_agent():
+    """
+    Compiles the LangGraph agent once; the topology is identical across reruns and sessions.
+    Its MemorySaver checkpointer is shared by all sessions; get_checkpoint_threads() bounds it.
+    """
+    return build_email_agent()
+
+@st.cache_resource
+def get_checkpoint_threads():
+    """
+    Hands out checkpoint thread ids for the shared agent and keeps at most CHECKPOINT_THREADS
+    of them, so threads left behind by ended or idle sessions don't pile up until restart.
+    """
+    return CheckpointThreads(get_compiled_agent().checkpointer, max_threads=CHECKPOINT_THREADS)
+
+@st.cache_resource
+def get_smtp_pool():
+    """
+    One bounded pool of persistent SMTP sessions for the process. Least recently used and
+    idle connections are closed as they are evicted; the rest are closed cleanly at shutdown.
+    """
+    pool = SMTPConnectionPool(max_entries=SMTP_POOL_SIZE, idle_ttl=SMTP_IDLE_TTL)
+    atexit.register(pool.close_all)
+    return pool
+
+def get_smtp(host: str, port: int, user: str, pwd: str):
+    """
+    Returns the persistent SMTP session for this credential set, so the TLS handshake
+    and AUTH are paid once instead of on every send.
+    """
+    return get_smtp_pool().get(user, pwd, host, port)
+
+@st.cache_resource(show_spinner=False)
+def get_llm(api_key: str):
+    """
+    Builds the Gemini client once per API key, already bound to the structured
+    draft + decision schema, so the HTTP client is reused across reruns.
+    """
+    llm = create_llm(api_key=api_key)
+    return llm.with_structured_output(EmailDecisionSchema)
+
+# --- Cached Data ---
+
+class _UncachedDraft(Exception):
+    """Carries a draft out of cached_draft without storing it: st.cache_data never caches exceptions."""
+    def __init__(self, draft):
+        super().__init__("draft not cached")
+        self.draft = draft
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def cached_draft(goal: str, recipient: str, model_id: str, api_key_hash: str, _llm):
+    """
+    Memoizes the draft + decision LLM call on (goal, recipient, model_id, api_key_hash), so
+    clicking again with the same inputs and key costs no LLM round-trip. REVISE verdicts are
+    not cached, so resubmitting always asks for a fresh draft. The send itself is never cached.
+    """
+    draft = compose_email(_llm, goal, recipient)
+    if draft['decision'] == "REVISE":
+        raise _UncachedDraft(draft)
+    return draft
+
+def draft_email(goal: str, recipient: str, model_id: str, api_key_hash: str, llm):
+    """Returns the (possibly cached) draft, passing REVISE verdicts through uncached."""
+    try:
+        return cached_draft(goal, recipient, model_id, api_key_hash, llm)
+    except _UncachedDraft as e:
+        return e.draft
+
+def with_script_ctx(fn):
+    """
+    draft_and_decide runs the draft call in an asyncio worker thread. Attaching this script's
+    context to that thread lets st.cache_data resolve the session as it would on the script thread.
+    The threads belong to the per-click asyncio.run executor, which is shut down when the run ends.
+    """
+    ctx = get_script_run_ctx()
+    def run_with_ctx(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return run_with_ctx
+
 # --- Session State and Input Fields ---
 
 if 'goal' not in st.session_state: st.session_state.goal = ""
 if 'recipient' not in st.session_state: st.session_state.recipient = ""
 if 'email_state' not in st.session_state: st.session_state.email_state = None
+if 'thread_id' not in st.session_state: st.session_state.thread_id = None
+
+# A form batches the inputs: the script only reruns on submit, not on every keystroke.
+with st.form("goal_form"):
+    col_input, col_recipient = st.columns([3, 1])
+    with col_recipient:
+        recipient_input = st.text_input("Recipient Email:", value=st.session_state.recipient, key="recipient_input", placeholder="name@example.com")
+    with col_input:
+        goal_input = st.text_area("Email Goal (What should the email achieve?):", value=st.session_state.goal, key="goal_input", height=100, placeholder="e.g., Ask Sarah for the updated Q4 sales figures and schedule a quick sync.")
+    submitted = st.form_submit_button("Generate & Decide to Send", type="primary")
+
 
-col_input, col_recipient = st.columns([3, 1])
-with col_recipient:
-    recipient_input = st.text_input("Recipient Email:", value=st.session_state.recipient, key="recipient_input", placeholder="name@example.com")
-with col_input:
-    goal_input = st.text_area("Email Goal (What should the email achieve?):", value=st.session_state.goal, key="goal_input", height=100, placeholder="e.g., Ask Sarah for the updated Q4 sales figures and schedule a quick sync.")
+# --- Agent Execution Functions ---
 
+def build_send_config(thread_id: str):
+    """Passes the checkpoint thread and the session's SMTP resources to the graph through the run config."""
+    smtp = get_smtp(EMAIL_HOST, EMAIL_PORT, smtp_username, smtp_password)
+    send_email = partial(send_email_func, smtp=smtp)
+    return {"configurable": {"thread_id": thread_id, "send_email": send_email, "smtp": smtp}}
 
-# --- Agent Execution Function ---
+def build_compose():
+    """Returns the session's memoized drafting call, backed by the cached LLM Client."""
+    llm = get_llm(gemini_key)
+    api_key_hash = hashlib.sha256(gemini_key.encode()).hexdigest()
+    return with_script_ctx(partial(draft_email, model_id=MODEL_ID, api_key_hash=api_key_hash, llm=llm))
+
+def retry_send():
+    """
+    Resumes the last run from its checkpoint before tool_executor; no LLM call is repeated.
+    Returns True when the session state was updated with the new result.
+    """
+    # Only the send runs again, so only the SMTP credentials are needed
+    if not smtp_password or not smtp_username:
+        st.error("Please enter the SMTP credentials in the sidebar.")
+        return False
+
+    with st.spinner("Retrying the send with the existing draft..."):
+        try:
+            run_config = build_send_config(st.session_state.thread_id)
+            st.session_state.email_state = asyncio.run(resume_from_send(get_compiled_agent(), run_config))
+            return True
+        except Exception as e:
+            st.error(f"An error occurred while retrying the send: {e}")
+            return False
 
 def run_agent():
     st.session_state.goal = st.session_state.goal_input
@@ -49,74 +176,75 @@ def run_agent():
     if not st.session_state.goal or not st.session_state.recipient:
         st.error("Please enter both the Email Goal and the Recipient.")
         return
+    if parse_recipient(st.session_state.recipient) is None:
+        st.error("Please enter a single valid Recipient email address (e.g., name@example.com).")
+        return
     if not gemini_key or not smtp_password or not smtp_username:
         st.error("Please enter all required API keys and SMTP credentials in the sidebar.")
         return
 
-    with st.spinner(f"Running LangGraph agent for goal: **{st.session_state.goal}**..."):
+    with st.status(f"Running LangGraph agent for goal: **{st.session_state.goal}**...", expanded=True) as progress:
         
-        # 2. Dynamic Tool Creation (using user-provided credentials)
-        try:
-            # Create a tool instance that closes over the user's credentials
-            dynamic_send_email_tool = StructuredTool.from_function(
-                func=lambda recipient, subject, body: send_email_func(
-                    recipient=recipient, 
-                    subject=subject, 
-                    body=body,
-                    host=EMAIL_HOST,
-                    port=EMAIL_PORT,
-                    username=smtp_username,
-                    password=smtp_password
-                ),
-                name="send_email",
-                description="A tool to send a completed email to a specified recipient.",
-                # 🛑 FIX: Use the imported Pydantic class as the args_schema
-                args_schema=SendEmailArgsSchema 
-            )
-            dynamic_tools = [dynamic_send_email_tool]
-            
-        except Exception as e:
-            st.error(f"Error creating tool: {e}. Check function signature in tools.py.")
-            return
-
-        # 3. Dynamic LLM Initialization
-        llm = create_llm(api_key=gemini_key)
-        
-        # 4. Bind LLM to Tools
-        llm_with_tools = llm.bind(functions=[convert_to_openai_function(t) for t in dynamic_tools])
+        # 2. Each run gets its own checkpoint thread, so a failed send can be resumed later.
+        #    Retry only needs the session's latest run: its previous thread is deleted now, and
+        #    the oldest threads overall are deleted once more than CHECKPOINT_THREADS are kept.
+        st.session_state.thread_id = get_checkpoint_threads().new_thread(previous=st.session_state.thread_id)
+        run_config = build_send_config(st.session_state.thread_id)
+        run_config["configurable"]["compose"] = build_compose()
         
-        # 5. Set the global AGENT_CONFIG for graph.py to use
-        AGENT_CONFIG["llm_with_tools"] = llm_with_tools
-        AGENT_CONFIG["tools"] = dynamic_tools
-        
-        # 6. Re-compile and Run the Agent
-        # Re-compile to ensure the LangGraph nodes use the newly configured AGENT_CONFIG
-        email_agent = build_email_agent() 
+        # 3. Fetch the cached Agent and Run it
+        email_agent = get_compiled_agent()
         
         initial_state = AgentState(
             goal=st.session_state.goal,
             recipient=st.session_state.recipient,
             subject="",
             body="",
+            decision="",
             review_feedback="",
             status="",
-            logs=[],
-            messages=[]
+            smtp_auth_error="",
+            logs=[]
         )
         
+        progress.write("✍️ Drafting the email and warming up the SMTP session in parallel...")
+        
+        async def stream_agent():
+            # Runs on this script thread inside asyncio.run, so the Streamlit calls below are safe.
+            # aclosing() shuts the graph stream down even if a Streamlit rerun/stop interrupts the loop.
+            final_state = None
+            events = email_agent.astream(initial_state, config=run_config, stream_mode=["updates", "values"])
+            async with aclosing(events):
+                async for mode, chunk in events:
+                    if mode == "values":
+                        final_state = chunk
+                        continue
+                    # Report each node as it finishes
+                    if "smtp_warmup" in chunk:
+                        progress.write("🔌 SMTP session warm-up finished.")
+                    if "draft_and_decide" in chunk:
+                        draft = chunk["draft_and_decide"]
+                        progress.write(f"📝 Draft ready: **{draft['subject']}** (decision: {draft['decision']})")
+                        if draft['decision'] == "SEND":
+                            progress.update(label="Sending the email...")
+                    if "tool_executor" in chunk:
+                        progress.write("📨 Send attempted.")
+            return final_state
+        
         try:
-            # Run the entire graph. Call invoke on the compiled agent object.
-            final_state = email_agent.invoke(initial_state)
+            # Stream the graph. The nodes are async so the parallel branches actually overlap.
+            final_state = asyncio.run(stream_agent())
             st.session_state.email_state = final_state
-            st.success("Agent workflow completed!")
+            progress.update(label="Agent workflow completed!", state="complete", expanded=False)
         except Exception as e:
+            progress.update(label="Agent workflow failed.", state="error")
             st.error(f"An error occurred during agent execution: {e}")
             st.session_state.email_state = None
 
 # --- Main App Body ---
 
-# Button to start the process
-if st.button("Generate & Decide to Send", type="primary"):
+# Form submit starts the process
+if submitted:
     run_agent()
 
 # --- Display Results and Logs ---
@@ -146,12 +274,15 @@ if st.session_state.email_state:
             st.header("❌ Tool Execution Error")
             # If status is an error, it's now a credential error, not a tool error
             st.error(f"Final Status: {state['status']}. Check your SMTP credentials in the sidebar.")
+            if st.session_state.thread_id and st.button("🔁 Retry Sending"):
+                if retry_send():
+                    st.rerun()
             
         st.subheader(f"Generated Subject: {state['subject']}")
         st.code(state['body'], language="markdown")
 
     # Check 2: Feedback from the Decision Maker node (Status is EMPTY, meaning conditional END was met)
-    elif "REVISION:" in state['review_feedback']:
+    elif state.get('decision') == "REVISE":
         
         st.header("⚠️ Draft Requires Review")
         st.warning("The agent decided **not** to send the email.")
@@ -163,7 +294,7 @@ if st.session_state.email_state:
         
         with col2:
             st.subheader("Agent Feedback")
-            feedback_text = state['review_feedback'].replace("REVISION:", "").strip()
+            feedback_text = state['review_feedback'].strip()
             if feedback_text:
                  st.error(feedback_text)
             else:
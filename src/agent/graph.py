@@ -1,15 +1,54 @@
 # src/agent/graph.py
-from langgraph.graph import StateGraph, END
-from langchain_core.messages import HumanMessage, AIMessage
-from typing import Dict, Any
-from langchain_core.messages.utils import get_buffer_string
+import asyncio
+import smtplib
+import threading
+import uuid
+from collections import OrderedDict
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
+from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.prompts import ChatPromptTemplate
+from typing import Dict, Any, Literal, Optional
+from pydantic import BaseModel, Field
+from langchain_core.runnables import RunnableConfig
 from src.agent.state import AgentState
-from src.agent.tools import tools, send_email  # We keep tools/send_email imports for graph compilation
-# from src.core.llm import llm_with_tools # <--- REMOVED
+from src.agent.tools import AUTH_FAILED_STATUS
 
 # --- Dynamic Configuration Bridge ---
-# This dictionary will be populated by app.py with the user's LLM and Tools
-AGENT_CONFIG = {"llm_with_tools": None, "tools": None}
+# app.py passes the user's drafting function, send function and SMTP connection per run via config={"configurable": {...}},
+# so the compiled graph itself holds no session state and can be cached.
+def get_configurable(config: RunnableConfig, key: str):
+    value = config.get("configurable", {}).get(key)
+    if not value: raise Exception(f"'{key}' not configured in the run config. Check app.py setup.")
+    return value
+
+# --- Pydantic Schema for the Structured Draft + Decision ---
+class EmailDecisionSchema(BaseModel):
+    """A drafted email together with the decision on whether to send it."""
+    subject: str = Field(..., description="The subject line of the email.")
+    body: str = Field(..., description="The full text content of the email.")
+    decision: Literal["SEND", "REVISE"] = Field(..., description="SEND if the draft is ready to go, REVISE if it is genuinely lacking.")
+    feedback: str = Field("", description="Concise reason for a REVISE decision. Empty when sending.")
+
+# --- Prompts ---
+# Built once at import.
+_DRAFT_SYSTEM_PROMPT = (
+    "You are a professional Email Drafting Agent and Orchestrator. Write a concise, professional "
+    "email subject and body based on the user's goal, then review your own draft for "
+    "professionalism and completeness. The primary goal is to send a good email."
+    "\n\nDECISION 1: **SEND**"
+    "\nIf the draft is professional, complete, and ready to go, set `decision` to 'SEND' and leave `feedback` empty."
+    "\n\nDECISION 2: **REVISE**"
+    "\nIf the goal is too vague to produce an acceptable email, set `decision` to 'REVISE' and give your concise reason in `feedback`."
+    "\n\nDECISION PRIORITY: Use SEND if the email is acceptable. Only use REVISE if it's genuinely bad."
+)
+
+_DRAFT_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("human", _DRAFT_SYSTEM_PROMPT + "\n\nGOAL: {goal}\nRECIPIENT: {recipient}")
+])
+
+# Longest the graph waits on the SMTP warm-up branch (seconds); roughly a fast LLM round-trip
+SMTP_WARMUP_TIMEOUT = 2
 
 # --- Utility for Logging ---
 def log_step(name: str, status: str, details: str = "") -> Dict[str, Any]:
@@ -17,179 +56,127 @@ def log_step(name: str, status: str, details: str = "") -> Dict[str, Any]:
 
 # --- Nodes (Functions) ---
 
-def generate_draft(state: AgentState):
-    """Generates the initial subject and body content based on the goal."""
-    
-    # CRITICAL: Fetch the dynamic LLM
-    llm_with_tools = AGENT_CONFIG.get("llm_with_tools")
-    if not llm_with_tools: raise Exception("LLM not configured in AGENT_CONFIG. Check app.py setup.")
-
-    system_prompt = (
-        "You are a professional Email Drafting Agent. Write a concise, professional "
-        "email subject and body based on the user's goal. "
-        "Your entire response MUST start with 'SUBJECT:' followed by the subject, and then a newline, "
-        "followed by 'BODY:' followed by the full email body. Do not include any other text."
-    )
-    prompt = f"{system_prompt}\n\nGOAL: {state['goal']}\nRECIPIENT: {state['recipient']}"
-    
-    response = llm_with_tools.invoke([HumanMessage(content=prompt)])
+def compose_email(llm, goal: str, recipient: str) -> Dict[str, Any]:
+    """
+    Drafts the email and decides SEND/REVISE in one structured LLM call.
+    Returns a plain dict so app.py can memoize it with st.cache_data.
+    """
+    messages = _DRAFT_PROMPT_TEMPLATE.format_messages(goal=goal, recipient=recipient)
+    response = llm.invoke(messages)
+    # The structured parser yields None when the model skips the schema; fail clearly instead of an AttributeError
+    if response is None:
+        raise ValueError("LLM response did not follow the EmailDecisionSchema format.")
+    return response.model_dump()
+
+async def draft_and_decide(state: AgentState, config: RunnableConfig):
+    """
+    Single LLM node: drafts the subject and body for the goal and, in the same call,
+    decides whether the draft is ready to SEND or needs a REVISE.
+    """
     
-    # Universal Fix for Content Extraction
-    try:
-        raw_content = get_buffer_string([response])
-    except:
-        raw_content = str(response)
-
-    try:
-        # Strict parsing based on the prompt's required format
-        subject_part, body_part = raw_content.split('\nBODY:', 1)
-        subject = subject_part.replace('SUBJECT:', '').strip()
-        body = body_part.strip()
-        
-        log = log_step("Draft_Creator", "Success", f"Subject drafted: {subject[:40]}...")
-        
-    except ValueError:
-        subject = "ERROR: Drafting Failed"
-        body = raw_content
-        log = log_step("Draft_Creator", "Error", "LLM response did not follow strict SUBJECT:/BODY: format.")
-
-    # Ensure logs are appended correctly
-    current_logs = state.get("logs", [])
-    current_logs.append(log)
+    # CRITICAL: Fetch the dynamic drafting function (compose_email, memoized by app.py)
+    compose = get_configurable(config, "compose")
 
-    return {
-        "subject": subject,
-        "body": body,
-        "logs": current_logs, 
-        "messages": [AIMessage(content=f"Subject: {subject}\nBody: {body}")] 
-    }
-
-def review_and_decide(state: AgentState):
-    """LLM node to review the draft and decide whether to send or provide feedback."""
-    
-    # CRITICAL: Fetch the dynamic LLM
-    llm_with_tools = AGENT_CONFIG.get("llm_with_tools")
-    if not llm_with_tools: raise Exception("LLM not configured in AGENT_CONFIG. Check app.py setup.")
+    # The memoized call is synchronous; run it in a worker thread so smtp_warmup still overlaps it
+    draft = await asyncio.to_thread(compose, state['goal'], state['recipient'])
     
-    # CRITICAL PROMPT UPDATE FOR SENDING 
-    system_prompt = (
-        "You are the Email Orchestrator. Review the draft for professionalism and completeness. "
-        "You have only two possible actions. The primary goal is to send a good email."
-        "\n\nACTION 1: **SEND EMAIL**"
-        "\nIf the draft is professional, complete, and ready to go, you **MUST** proceed directly to call the `send_email` tool, "
-        "providing the exact `recipient`, `subject`, and `body`."
-        "\n\nACTION 2: **REQUEST REVISION**"
-        "\nIf the draft is lacking, unprofessional, or incomplete, you **MUST** respond ONLY with the word 'REVISION:', followed by your concise reason. DO NOT call the tool."
-        "\n\nDECISION PRIORITY: Use ACTION 1 if the email is acceptable. Only use ACTION 2 if it's genuinely bad."
-    )
-    
-    messages = [
-        HumanMessage(content=system_prompt),
-        AIMessage(content=f"Draft Subject: {state['subject']}\n\nDraft Body:\n---\n{state['body']}\n---")
+    logs = [
+        log_step("Draft_Creator", "Success", f"Subject drafted: {draft['subject'][:40]}..."),
+        log_step("Decision_Maker", "Complete", f"Decided to: {'Send Email' if draft['decision'] == 'SEND' else 'Give Feedback'}")
     ]
-    
-    response = llm_with_tools.invoke(messages)
-    
-    current_logs = state.get("logs", [])
-    log = log_step("Decision_Maker", "Complete", f"Decided to: {'Call Tool' if response.tool_calls else 'Give Feedback'}")
-    current_logs.append(log)
-    
+
     return {
-        "review_feedback": response.content, 
-        "messages": [response],
-        "logs": current_logs
+        "subject": draft['subject'],
+        "body": draft['body'],
+        "decision": draft['decision'],
+        "review_feedback": draft['feedback'],
+        "logs": logs
     }
 
-def tool_executor(state: AgentState):
+async def smtp_warmup(state: AgentState, config: RunnableConfig):
     """
-    Executes the send_email tool, handling both explicit tool calls and forced execution 
-    by synthesizing the arguments from the state.
+    Runs alongside draft_and_decide: opens the cached SMTP session (TLS + AUTH) while
+    the LLM is still drafting, so the handshake is off the critical path.
+    A rejected login is recorded so tool_executor reports it instead of logging in again;
+    other failures are left for tool_executor to retry when it actually sends.
     """
-    # CRITICAL: Fetch the dynamic Tools list
-    dynamic_tools = AGENT_CONFIG.get("tools")
-    if not dynamic_tools: raise Exception("Tools not configured in AGENT_CONFIG. Check app.py setup.")
-
-    tool_calls = state['messages'][-1].tool_calls if state['messages'] else None
-    current_logs = state.get("logs", [])
-    
-    # --- Check 1: Explicit Tool Call Found ---
-    if tool_calls:
-        tool_call = tool_calls[0]
-        tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-        
-        # Use the dynamic tools list
-        tool_to_run = next(t for t in dynamic_tools if t.name == tool_name)
-        tool_result = tool_to_run.invoke(tool_args)
-        
-    # --- Check 2: No Explicit Tool Call (Forced Execution) ---
-    else:
-        # Synthesize arguments directly from the state for the forced execution path.
-        try:
-            # Find the specific send_email tool object from the dynamic list
-            send_email_tool = next(t for t in dynamic_tools if t.name == "send_email")
-            
-            # FINAL FIX: Call the tool using .invoke() and pass arguments as a dict 
-            tool_result = send_email_tool.invoke({
-                "recipient": state['recipient'],
-                "subject": state['subject'],
-                "body": state['body']
-            })
-            
-            log = log_step("Tool_Executor", "Forced_Success", "Tool call was synthesized and executed.")
-            current_logs.append(log)
-            # Return result and exit node
-            return {"status": tool_result, "logs": current_logs, "messages": []}
-
-        except Exception as e:
-            # Handle potential exceptions during manual call 
-            log = log_step("Tool_Executor", "Forced_Error", f"Manual tool execution failed. Check .env: {str(e)}")
-            current_logs.append(log)
-            # Return error result and exit node
-            return {"status": f"ERROR: Manual execution failed. Details: {str(e)}", "logs": current_logs, "messages": []}
-
+    smtp = get_configurable(config, "smtp")
+    try:
+        # smtplib is blocking; run it in a worker thread so the LLM call keeps the event loop.
+        # The graph joins on this node, so cap the wait: a slow server must not hold up the run
+        # (including REVISE runs that never send). A capped warm-up keeps going in its thread,
+        # and tool_executor's send simply waits for the connection lock.
+        await asyncio.wait_for(asyncio.to_thread(smtp.warm_up), timeout=SMTP_WARMUP_TIMEOUT)
+        log = log_step("SMTP_Warmup", "Success", "SMTP session opened in parallel with drafting.")
+    except asyncio.TimeoutError:
+        log = log_step("SMTP_Warmup", "Skipped", f"Warm-up still running after {SMTP_WARMUP_TIMEOUT}s; not waiting for it.")
+    except smtplib.SMTPAuthenticationError:
+        log = log_step("SMTP_Warmup", "Error", "SMTP server rejected the credentials.")
+        return {"logs": [log], "smtp_auth_error": AUTH_FAILED_STATUS}
+    except Exception as e:
+        log = log_step("SMTP_Warmup", "Skipped", f"Warm-up failed, the send will retry: {str(e)}")
+    return {"logs": [log]}
+
+async def tool_executor(state: AgentState, config: RunnableConfig):
+    """
+    Sends the drafted email. Routing only reaches this node on a SEND decision,
+    so the arguments come straight from the state; no tool-call parsing is needed.
+    """
+    # CRITICAL: Fetch the dynamic send function (send_email_func bound to the session's SMTP connection)
+    send_email_fn = get_configurable(config, "send_email")
+
+    # The warm-up already had its login rejected: report that rather than making a second failed AUTH.
+    # An explicit retry (resume_from_send) always makes a fresh attempt.
+    if state.get("smtp_auth_error") and not config.get("configurable", {}).get("retry"):
+        log = log_step("Tool_Executor", "Error", "Not sent: SMTP login was already rejected during warm-up.")
+        return {"status": state["smtp_auth_error"], "logs": [log]}
+
+    # smtplib is blocking; run it in a worker thread. send_email_func reports failures as an ERROR status.
+    tool_result = await asyncio.to_thread(
+        send_email_fn,
+        recipient=state['recipient'],
+        subject=state['subject'],
+        body=state['body']
+    )
 
     log = log_step("Tool_Executor", "Complete", f"Tool output: {tool_result}")
-    current_logs.append(log)
     
-    return {"status": tool_result, "logs": current_logs, "messages": []}
+    return {"status": tool_result, "logs": [log]}
+
+def dispatch_branches(state: AgentState):
+    """Fans out from START: drafting and SMTP warm-up do not depend on each other."""
+    return [Send("draft_and_decide", state), Send("smtp_warmup", state)]
 
 def route_next_step(state: AgentState):
     """
-    Conditional edge to decide where to go after review_and_decide. 
-    Implements a fail-safe: if no tool call but no explicit rejection, force tool execution.
+    Conditional edge to decide where to go after draft_and_decide. 
+    Reads the structured decision directly: only an explicit REVISE stops the send.
     """
-    # Check 1: Tool call is explicitly made
-    if state['messages'][-1].tool_calls:
-        return "tool_executor"
-    
-    # Check 2: Explicit rejection text is found (using the REVISION keyword)
-    elif "REVISION:" in state['review_feedback']:
-         return "END_FEEDBACK"
-
-    # Fail-Safe: If no explicit tool call or rejection was made, we force tool execution.
-    else:
-        return "tool_executor" 
+    if state['decision'] == "REVISE":
+        return "END_FEEDBACK"
+    return "tool_executor"
 
 # --- Build the Graph ---
 
 def build_email_agent():
     """
     Compiles and returns the LangGraph agent. 
-    It relies on AGENT_CONFIG being set by app.py before invocation.
+    The topology is static; the LLM and Tools are supplied per run through
+    config["configurable"], so app.py can compile this once and cache it.
+    Every step is checkpointed per thread_id, so a failed send can be resumed.
     """
     workflow = StateGraph(AgentState)
 
-    workflow.add_node("draft_creator", generate_draft)
-    workflow.add_node("decision_maker", review_and_decide)
+    workflow.add_node("draft_and_decide", draft_and_decide)
+    workflow.add_node("smtp_warmup", smtp_warmup)
     workflow.add_node("tool_executor", tool_executor)
 
-    workflow.set_entry_point("draft_creator")
-
-    workflow.add_edge("draft_creator", "decision_maker")
+    # Both branches run in the same step; tool_executor only starts once both are done.
+    workflow.add_conditional_edges(START, dispatch_branches, ["draft_and_decide", "smtp_warmup"])
+    workflow.add_edge("smtp_warmup", END)
     
     workflow.add_conditional_edges(
-        "decision_maker",
+        "draft_and_decide",
         route_next_step,
         {
             "tool_executor": "tool_executor", 
@@ -199,7 +186,42 @@ def build_email_agent():
     
     workflow.add_edge("tool_executor", END)
     
-    return workflow.compile()
+    return workflow.compile(checkpointer=MemorySaver())
 
-# Initialize the agent (Compiler will use the imports from the top of the file)
-email_agent = build_email_agent()
\ No newline at end of file
+class CheckpointThreads:
+    """
+    Keeps a shared checkpointer bounded: hands out thread ids, deletes the caller's previous
+    thread, and deletes the oldest threads once more than `max_threads` are live. Threads of
+    sessions that ended or went idle are therefore dropped as newer runs arrive.
+    """
+    def __init__(self, checkpointer, max_threads: int = 64):
+        self.checkpointer = checkpointer
+        self.max_threads = max_threads
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new_thread(self, previous: Optional[str] = None) -> str:
+        thread_id = uuid.uuid4().hex
+        with self._lock:
+            stale = []
+            # An untracked previous id was already evicted (and deleted) as one of the oldest
+            if previous in self._threads:
+                del self._threads[previous]
+                stale.append(previous)
+            self._threads[thread_id] = None
+            while len(self._threads) > self.max_threads:
+                stale.append(self._threads.popitem(last=False)[0])
+        for old_id in stale:
+            self.checkpointer.delete_thread(old_id)
+        return thread_id
+
+async def resume_from_send(email_agent, config: RunnableConfig):
+    """
+    Re-runs only tool_executor for a finished run, starting from the checkpoint saved
+    just before it, so the existing draft is reused instead of calling the LLM again.
+    """
+    async for snapshot in email_agent.aget_state_history(config):
+        if snapshot.next == ("tool_executor",):
+            checkpoint_config = {"configurable": {**config["configurable"], **snapshot.config["configurable"], "retry": True}}
+            return await email_agent.ainvoke(None, config=checkpoint_config)
+    raise Exception("No checkpoint before tool_executor found for this run. Generate the email again.")
@@ -1,7 +1,6 @@
 # src/agent/state.py
+import operator
 from typing import TypedDict, Annotated, List, Dict, Any
-from langgraph.graph.message import add_messages
-from langchain_core.messages import BaseMessage
 
 class AgentState(TypedDict):
     """
@@ -11,11 +10,11 @@ class AgentState(TypedDict):
     recipient: str
     subject: str
     body: str
+    decision: str
     review_feedback: str
     status: str
+    smtp_auth_error: str
     
-    # CORRECTED: Logs are NOT annotated with add_messages.
-    logs: List[Dict[str, Any]] 
-    
-    # Messages use the annotation for incremental history building
-    messages: Annotated[List[BaseMessage], add_messages]
\ No newline at end of file
+    # Logs use operator.add: each node returns only its new entries and LangGraph
+    # concatenates them, which also merges logs from parallel branches safely.
+    logs: Annotated[List[Dict[str, Any]], operator.add]
\ No newline at end of file
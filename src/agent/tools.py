@@ -1,17 +1,159 @@
 # src/agent/tools.py
-import os
+import hashlib
 import smtplib
+import threading
+import time
+from collections import OrderedDict
 from email.mime.text import MIMEText
+from email.utils import getaddresses
 from typing import Optional
-from langchain_core.tools import tool
-from pydantic import BaseModel, Field # <--- CRITICAL Pydantic Imports
 
-# --- Pydantic Schema for Tool Input ---
-class SendEmailArgsSchema(BaseModel):
-    """Input parameters for the send_email tool."""
-    recipient: str = Field(..., description="The full email address of the recipient.")
-    subject: str = Field(..., description="The subject line of the email.")
-    body: str = Field(..., description="The main text content of the email.")
+# Status reported when the SMTP server rejects the credentials
+AUTH_FAILED_STATUS = "ERROR: SMTP Authentication failed. Check username and password."
+
+# --- Persistent SMTP Connection ---
+
+class SMTPConnectionClosed(smtplib.SMTPException):
+    """Raised when a connection that was closed (e.g. evicted from the pool) is used again."""
+
+class SMTPConnection:
+    """
+    Holds one logged-in SMTP session that is reused across sends.
+    Connects lazily, checks liveness with NOOP and reconnects if the server dropped us.
+    Once close() is called it never reconnects; callers must get a fresh one from the pool.
+    """
+    def __init__(self, username: str, password: str, host: str = "smtp.gmail.com", port: int = 587, timeout: float = 10):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        # Bounds every blocking socket operation: connect, STARTTLS, AUTH, NOOP and send
+        self.timeout = timeout
+        self._server: Optional[smtplib.SMTP] = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        # Connect to the SMTP server and start TLS encryption. STARTTLS and login run on the same
+        # socket, so they inherit the connect timeout instead of waiting on the OS TCP timeout.
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _is_alive(self) -> bool:
+        try:
+            return self._server is not None and self._server.noop()[0] == 250
+        except smtplib.SMTPServerDisconnected:
+            return False
+
+    def _ensure_connected(self) -> smtplib.SMTP:
+        if self._closed:
+            # Reopening here would create a logged-in session the pool no longer tracks or closes
+            raise SMTPConnectionClosed("SMTP session was closed. Retry to open a new one.")
+        if not self._is_alive():
+            self._close()
+            self._server = self._connect()
+        return self._server
+
+    def warm_up(self) -> None:
+        """Opens (or health-checks) the session ahead of the first send."""
+        with self._lock:
+            self._ensure_connected()
+
+    def send_message(self, msg: MIMEText) -> None:
+        with self._lock:
+            try:
+                self._ensure_connected().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # The session died between the health check and the send; retry once.
+                self._close()
+                self._ensure_connected().send_message(msg)
+
+    def _close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                self._server.close()
+            self._server = None
+
+    def close(self) -> None:
+        """Closes the session cleanly and for good. Safe to call more than once."""
+        with self._lock:
+            self._closed = True
+            self._close()
+
+# --- Bounded Pool of SMTP Connections ---
+
+class SMTPConnectionPool:
+    """
+    Keeps at most `max_entries` SMTPConnection objects, one per credential set, and closes
+    any that are evicted (least recently used) or idle for longer than `idle_ttl` seconds.
+    Passwords are only kept inside the connections; the pool keys on their hash.
+    """
+    def __init__(self, max_entries: int = 16, idle_ttl: float = 600):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._connections = OrderedDict()  # credential key -> (SMTPConnection, last used)
+        self._lock = threading.Lock()
+
+    def get(self, username: str, password: str, host: str = "smtp.gmail.com", port: int = 587) -> SMTPConnection:
+        key = (host, port, username, hashlib.sha256(password.encode()).hexdigest())
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            # Drop connections nobody has used recently
+            for other_key, (conn, last_used) in list(self._connections.items()):
+                if other_key != key and now - last_used > self.idle_ttl:
+                    evicted.append(self._connections.pop(other_key)[0])
+
+            if key in self._connections:
+                smtp = self._connections.pop(key)[0]
+            else:
+                smtp = SMTPConnection(username=username, password=password, host=host, port=port)
+            self._connections[key] = (smtp, now)
+
+            while len(self._connections) > self.max_entries:
+                evicted.append(self._connections.popitem(last=False)[1][0])
+
+        # Close outside the pool lock: quit() may block on the network
+        for conn in evicted:
+            conn.close()
+        return smtp
+
+    def close_all(self) -> None:
+        """Closes every pooled connection. Safe to call more than once."""
+        with self._lock:
+            connections = [conn for conn, _ in self._connections.values()]
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+# --- Recipient Validation ---
+
+def parse_recipient(address: str) -> Optional[str]:
+    """
+    Cheap syntax check for a single recipient ("name@domain.tld", optionally with a display name).
+    Returns the bare address to put in the To header, or None when the input is not exactly one
+    well-formed address. Runs before any LLM call or SMTP handshake so bad input fails fast.
+    """
+    addresses = getaddresses([address])
+    if len(addresses) != 1:
+        return None
+    name, addr = addresses[0]
+    # The parser is lenient: make sure it consumed the whole input and nothing else was dropped
+    raw = address.strip()
+    if raw not in (addr, f"<{addr}>") and not (name and raw.endswith(f"<{addr}>")):
+        return None
+    local, at, domain = addr.rpartition("@")
+    if not (local and at and "." in domain.strip(".")) or any(c.isspace() for c in addr):
+        return None
+    return addr
 
 # --- Core Email Sending Function ---
 
@@ -19,49 +161,31 @@ def send_email_func(
     recipient: str, 
     subject: str, 
     body: str, 
-    username: str, 
-    password: str, 
-    host: str = "smtp.gmail.com", 
-    port: int = 587
+    smtp: SMTPConnection
 ) -> str:
     """
-    Core function to send an email using specified SMTP credentials.
+    Core function to send an email over a (reused) SMTP connection.
     Returns SUCCESS or an ERROR message.
     """
-    if not (username and password):
+    username = smtp.username
+    if not (username and smtp.password):
         return "ERROR: SMTP credentials missing. Cannot send email."
         
-    if "@" not in recipient:
+    to_addr = parse_recipient(recipient)
+    if to_addr is None:
         return "ERROR: Invalid recipient address format. Please check the recipient."
 
     msg = MIMEText(body)
     msg['Subject'] = subject
     msg['From'] = username
-    msg['To'] = recipient
+    msg['To'] = to_addr
 
     try:
-        # Connect to the SMTP server and start TLS encryption
-        with smtplib.SMTP(host, port) as server:
-            server.starttls()
-            server.login(username, password)
-            server.send_message(msg)
+        smtp.send_message(msg)
         
-        print(f"\n--- Email Sent ---\nRecipient: {recipient}\nSubject: {subject}\n--------------------")
-        return f"SUCCESS: Email titled '{subject}' sent to {recipient}."
+        print(f"\n--- Email Sent ---\nRecipient: {to_addr}\nSubject: {subject}\n--------------------")
+        return f"SUCCESS: Email titled '{subject}' sent to {to_addr}."
     except smtplib.SMTPAuthenticationError:
-        return "ERROR: SMTP Authentication failed. Check username and password."
+        return AUTH_FAILED_STATUS
     except Exception as e:
-        return f"ERROR: Failed to send email via SMTP. Details: {str(e)}"
-
-# --- Tool Definitions (Placeholder) ---
-
-@tool
-def send_email(recipient: str, subject: str, body: str) -> str:
-    """
-    A placeholder tool. The real tool must be dynamically created in app.py 
-    using send_email_func and user input credentials.
-    """
-    return "ERROR: Tool called without dynamic credentials. Check app.py setup."
-
-# List of tools available to the LangGraph agent
-tools = [send_email]
\ No newline at end of file
+        return f"ERROR: Failed to send email via SMTP. Details: {str(e)}"
\ No newline at end of file
@@ -1,7 +1,8 @@
 # src/core/llm.py
-import os
 from langchain_google_genai import ChatGoogleGenerativeAI
-# Note: Removed unused imports like dotenv and convert_to_openai_function since they are now handled externally
+
+# Part of the cache key for memoized drafts: a model change must not reuse old responses.
+MODEL_ID = "gemini-2.5-flash"
 
 def create_llm(api_key: str):
     """
@@ -16,11 +17,7 @@ def create_llm(api_key: str):
     # The ChatGoogleGenerativeAI constructor automatically uses the 'google_api_key' 
     # parameter, ensuring it uses the user's key over a system environment variable.
     return ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
+        model=MODEL_ID,
         temperature=0.7,
         google_api_key=api_key 
-    )
-
-# Note: The global llm_with_tools definition has been removed. 
-# This variable must now be defined dynamically in app.py after the user inputs 
-# the API key and before the LangGraph agent is invoked.
\ No newline at end of file
+    )
\ No newline at end of file